@@ -1,4 +1,6 @@
 import json
+import functools
+import re
 import time
 import logging
 import paho.mqtt.client as mqtt
@@ -7,10 +9,24 @@ import os
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 import platform
+import socket
+import random
 import pandas as pd
 
+try:
+    import dpkt  # Optional: only needed for the in-process "fast_pcap" reader
+except ImportError:
+    dpkt = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv  # Optional: multithreaded parsing of the tshark export
+except ImportError:
+    pa = pa_csv = None
+
 # --- Configuration Loading ---
 def load_config(config_file="config.json"):
     """
@@ -33,6 +49,8 @@ def load_config(config_file="config.json"):
         "tshark_enabled": False,
         "tshark_interface": "",
         "tshark_temp_capture_file": "temp_capture.pcap",
+        "tshark_snaplen": 128,
+        "fast_pcap": False,
         "camera_ips": [],
         "save_tshark_capture": False,
         "tshark_save_folder": "captures"
@@ -74,8 +92,8 @@ def on_connect(client, userdata, flags, rc):
         sys.exit(1)
 
 def on_publish(client, userdata, mid):
-    """Callback for MQTT message publication (not actively used)."""
-    pass
+    """Callback for MQTT message publication, invoked from the network thread."""
+    logging.debug("MQTT message mid=%s handed off to the broker.", mid)
 
 # --- FTP Folder Management ---
 def manage_specific_ftp_folder(folder_path):
@@ -86,19 +104,26 @@ def manage_specific_ftp_folder(folder_path):
         return 0, 0.0, 0
 
     try:
-        files = [f for f in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, f))]
-        num_before = len(files)
-        total_size = sum(os.path.getsize(os.path.join(folder_path, f)) for f in files)
+        # Single scandir pass: size each file from the cached stat and delete it right away
+        num_before, num_failed, total_size = 0, 0, 0
+        with os.scandir(folder_path) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                num_before += 1
+                try:
+                    total_size += entry.stat().st_size
+                    os.remove(entry.path)
+                except OSError as e:
+                    num_failed += 1
+                    logging.warning(f"Could not process '{entry.path}': {e}")
         avg_size_bytes = total_size / num_before if num_before > 0 else 0.0
-        
-        logging.info(f"Found {num_before} files with avg size {avg_size_bytes / (1024*1024):.4f} MB.")
 
-        for f in files:
-            os.remove(os.path.join(folder_path, f))
-        
-        time.sleep(1) # Wait for filesystem to update
-        num_after = len([f for f in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, f))])
-        logging.info(f"Deleted {num_before - num_after} files. {num_after} files remain.")
+        logging.info(f"Found {num_before} files in '{folder_path}' with avg size {avg_size_bytes / (1024*1024):.4f} MB.")
+
+        # Files whose removal failed are exactly the ones left behind, so no second scan is needed
+        num_after = num_failed
+        logging.info(f"Deleted {num_before - num_after} files from '{folder_path}'. {num_after} files remain.")
         
         return num_before, avg_size_bytes, num_after
     except Exception as e:
@@ -115,9 +140,10 @@ def init_google_sheet(sheet_name, worksheet_name, credentials_file="google_crede
         client = gspread.authorize(creds)
         sheet = client.open(sheet_name)
 
-        try:
-            worksheet = sheet.worksheet(worksheet_name)
-        except gspread.exceptions.WorksheetNotFound:
+        # One metadata fetch serves both the lookup by title and the sheetId check below
+        worksheets = sheet.worksheets()
+        worksheet = next((ws for ws in worksheets if ws.title == worksheet_name), None)
+        if worksheet is None:
             headers = [
                 "Timestamp", "Camera_IP", "interval_true_false_ms", "interval_false_true_ms",
                 "repeats_configured", "files_before_delete", "files_after_delete",
@@ -127,8 +153,26 @@ def init_google_sheet(sheet_name, worksheet_name, credentials_file="google_crede
                 "ftp_conn_opened_timestamp", "ftp_conn_closed_timestamp", 
                 "Max_Data_Bleed_ms", "FPS_Manual"
             ]
-            worksheet = sheet.add_worksheet(title=worksheet_name, rows=100, cols=len(headers))
-            worksheet.append_row(headers)
+            # Create the worksheet and write its header row in a single batchUpdate round trip.
+            # addSheet takes a caller-chosen sheetId so updateCells can target it in the same batch;
+            # it must not clash with an existing tab (e.g. an older one that was renamed).
+            existing_ids = {ws.id for ws in worksheets}
+            sheet_id = random.randrange(1, 2**31)
+            while sheet_id in existing_ids:
+                sheet_id = random.randrange(1, 2**31)
+            response = sheet.batch_update({"requests": [
+                {"addSheet": {"properties": {
+                    "sheetId": sheet_id, "title": worksheet_name,
+                    "gridProperties": {"rowCount": 100, "columnCount": len(headers)}
+                }}},
+                {"updateCells": {
+                    "rows": [{"values": [{"userEnteredValue": {"stringValue": h}} for h in headers]}],
+                    "fields": "userEnteredValue",
+                    "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0}
+                }}
+            ]})
+            properties = response["replies"][0]["addSheet"]["properties"]
+            worksheet = gspread.Worksheet(sheet, properties, sheet.id, sheet.client)
             logging.info(f"Created new worksheet '{worksheet_name}' with headers.")
         
         return worksheet
@@ -140,20 +184,84 @@ def init_google_sheet(sheet_name, worksheet_name, credentials_file="google_crede
         sys.exit(1)
 
 # --- Tshark Helper Functions ---
+# Column types for the tshark field export. Empty fields become NaN only in the
+# numeric columns; text columns keep '' so they can be compared directly.
+TSHARK_NUMERIC_DTYPES = {
+    "frame.time_epoch": "float64", "frame.len": "float64",
+    "tcp.analysis.retransmission": "float32", "tcp.analysis.zero_window": "float32",
+    "tcp.analysis.window_full": "float32", "tcp.analysis.lost_segment": "float32",
+    "tcp.analysis.duplicate_ack": "float32",
+    "tcp.analysis.ack_rtt": "float64", "tcp.analysis.rtt": "float64",
+    # FTP reply codes are 3-digit numbers; nullable so packets without a reply stay <NA>
+    "ftp.response.code": "Int16"
+}
+# The address and FTP command columns hold only a handful of distinct values, so they are loaded as categoricals
+TSHARK_TEXT_DTYPES = {
+    "ip.src": "category", "ip.dst": "category",
+    "ftp.request.command": "category",
+    "tcp.flags.syn": "string", "tcp.flags.fin": "string", "tcp.flags.reset": "string"
+}
+# tshark analysis flag columns (set to 1 when present) and the metric each one is counted into
+TSHARK_COUNTER_METRICS = {
+    "tcp.analysis.retransmission": "total_retransmissions",
+    "tcp.analysis.zero_window": "zero_window_count",
+    "tcp.analysis.window_full": "window_full_count",
+    "tcp.analysis.lost_segment": "lost_segments_count",
+    "tcp.analysis.duplicate_ack": "duplicate_ack_count"
+}
+# FTP commands that mark a camera logging in to / out of the server (matched without upper-casing the column)
+FTP_OPEN_COMMAND_RE = re.compile(r'^USER$', re.IGNORECASE)
+FTP_CLOSE_COMMAND_RE = re.compile(r'^QUIT$', re.IGNORECASE)
+# Remembers which RTT field the installed tshark provides, keyed by its version
+TSHARK_FIELD_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "mqtt_analyzer", "tshark_fields")
+
+def get_tshark_version():
+    """Returns the first line of 'tshark -v' (e.g. 'TShark (Wireshark) 4.2.2'), or None if unavailable."""
+    try:
+        result = subprocess.run(["tshark", "-v"], capture_output=True, text=True, check=True, timeout=10)
+        return result.stdout.splitlines()[0].strip() if result.stdout else None
+    except Exception as e:
+        logging.warning(f"Could not read tshark version: {e}.")
+        return None
+
+@functools.lru_cache(maxsize=1)
 def get_rtt_field_name():
     """Detects the correct RTT field name for the installed tshark version."""
+    # 'tshark -G fields' dumps every registered field and is slow, so the result is also cached on disk per tshark version
+    tshark_version = get_tshark_version()
+    try:
+        with open(TSHARK_FIELD_CACHE_FILE, 'r') as f:
+            cached = json.load(f)
+        if tshark_version and cached.get("tshark_version") == tshark_version:
+            rtt_field = cached.get("rtt_field")
+            if not rtt_field:
+                logging.warning("No RTT field found in tshark. RTT metrics will be unavailable.")
+            return rtt_field
+    except (OSError, ValueError, AttributeError):
+        pass
+
     try:
         result = subprocess.run(["tshark", "-G", "fields"], capture_output=True, text=True, check=True, timeout=10)
         if "tcp.analysis.ack_rtt" in result.stdout:
-            return "tcp.analysis.ack_rtt"
-        if "tcp.analysis.rtt" in result.stdout:
-            return "tcp.analysis.rtt"
-        logging.warning("No RTT field found in tshark. RTT metrics will be unavailable.")
-        return None
+            rtt_field = "tcp.analysis.ack_rtt"
+        elif "tcp.analysis.rtt" in result.stdout:
+            rtt_field = "tcp.analysis.rtt"
+        else:
+            logging.warning("No RTT field found in tshark. RTT metrics will be unavailable.")
+            rtt_field = None
     except Exception as e:
         logging.warning(f"Could not detect tshark RTT field: {e}. RTT metrics will be unavailable.")
         return None
 
+    if tshark_version:
+        try:
+            os.makedirs(os.path.dirname(TSHARK_FIELD_CACHE_FILE), exist_ok=True)
+            with open(TSHARK_FIELD_CACHE_FILE, 'w') as f:
+                json.dump({"tshark_version": tshark_version, "rtt_field": rtt_field}, f)
+        except OSError as e:
+            logging.warning(f"Could not write tshark field cache '{TSHARK_FIELD_CACHE_FILE}': {e}")
+    return rtt_field
+
 def get_tshark_export_fields():
     """Returns the list of fields to export from tshark."""
     fields = [
@@ -169,57 +277,291 @@ def get_tshark_export_fields():
         fields.extend(["-e", rtt_field])
     return fields
 
-def calculate_metrics(df, duration_s, rtt_field, camera_ips):
-    """Calculates network metrics from a pandas DataFrame."""
+def summarize_traffic_metrics(counts, total_bytes, rtt_mean_s, duration_s):
+    """Builds the counter, throughput and RTT metrics from pre-aggregated values."""
     metrics = {}
-    metrics["total_retransmissions"] = int((df['tcp.analysis.retransmission'] != '').sum()) if 'tcp.analysis.retransmission' in df.columns else 0
-    metrics["zero_window_count"]     = int((df['tcp.analysis.zero_window'] != '').sum()) if 'tcp.analysis.zero_window' in df.columns else 0
-    metrics["window_full_count"]     = int((df['tcp.analysis.window_full'] != '').sum()) if 'tcp.analysis.window_full' in df.columns else 0
-    metrics["lost_segments_count"]   = int((df['tcp.analysis.lost_segment'] != '').sum()) if 'tcp.analysis.lost_segment' in df.columns else 0
-    metrics["duplicate_ack_count"]   = int((df['tcp.analysis.duplicate_ack'] != '').sum()) if 'tcp.analysis.duplicate_ack' in df.columns else 0
-
-    if duration_s > 0 and 'frame.len' in df.columns:
-        total_bytes = df['frame.len'].sum()
+    for col, metric_name in TSHARK_COUNTER_METRICS.items():
+        metrics[metric_name] = int(counts[col])
+
+    if duration_s > 0:
         metrics["measured_throughput_Mbps"] = (total_bytes * 8) / (duration_s * 1024 * 1024)
     else:
         metrics["measured_throughput_Mbps"] = 0.0
 
-    if rtt_field in df.columns and df[rtt_field].astype(str).str.strip().ne('').any():
-        valid_rtts = pd.to_numeric(df[rtt_field], errors='coerce').dropna()
-        if not valid_rtts.empty:
-            metrics["avg_rtt_ms"] = valid_rtts.mean() * 1000
-        else:
-            metrics["avg_rtt_ms"] = 0.0
-    else:
-        metrics["avg_rtt_ms"] = 0.0
-
-    opened_ts, closed_ts = pd.NaT, pd.NaT
-    syn_events = df[(df['tcp.flags.syn'] == 'True') & (df['ip.src'].isin(camera_ips))]
-    if not syn_events.empty:
-        opened_ts = syn_events['frame.time'].min()
-
-    fin_rst_events = df[((df['tcp.flags.fin'] == 'True') | (df['tcp.flags.reset'] == 'True')) & ((df['ip.src'].isin(camera_ips)) | (df['ip.dst'].isin(camera_ips)))]
-    if not fin_rst_events.empty:
-        closed_ts = fin_rst_events['frame.time'].max()
+    metrics["avg_rtt_ms"] = rtt_mean_s * 1000 if pd.notna(rtt_mean_s) else 0.0
+    return metrics
 
-    if pd.isna(opened_ts) and 'ftp.response.code' in df.columns:
-        ftp_open_events = df[df['ftp.response.code'].str.startswith(('220', '230')) | df.get('ftp.request.command', pd.Series(dtype=str)).str.upper().str.contains('USER')]
+def format_epoch_timestamp(epoch_s):
+    """Formats epoch seconds as a UTC timestamp string with milliseconds, or '' if missing."""
+    if pd.isna(epoch_s):
+        return ""
+    return datetime.fromtimestamp(epoch_s, timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+def find_connection_timestamps(df, camera_ips):
+    """Finds when the cameras' connections were first opened and last closed."""
+    # Narrow to camera traffic once, then test the TCP flags on that subset only
+    src_is_camera = df['ip.src'].isin(camera_ips)
+    cam_mask = src_is_camera | df['ip.dst'].isin(camera_ips)
+    sub = df.loc[cam_mask, ['frame.time', 'tcp.flags.syn', 'tcp.flags.fin', 'tcp.flags.reset']]
+    opened_ts = sub.loc[(sub['tcp.flags.syn'] == 'True') & src_is_camera[cam_mask], 'frame.time'].min()
+    closed_ts = sub.loc[(sub['tcp.flags.fin'] == 'True') | (sub['tcp.flags.reset'] == 'True'), 'frame.time'].max()
+
+    has_ftp_command = 'ftp.request.command' in df.columns
+    has_ftp_response = 'ftp.response.code' in df.columns
+
+    if pd.isna(opened_ts) and has_ftp_response:
+        ftp_open_mask = df['ftp.response.code'].isin([220, 230])
+        if has_ftp_command:
+            ftp_open_mask |= df['ftp.request.command'].str.contains(FTP_OPEN_COMMAND_RE, na=False)
+        ftp_open_events = df[ftp_open_mask]
         if not ftp_open_events.empty:
             opened_ts = ftp_open_events['frame.time'].min()
 
-    if pd.isna(closed_ts) and 'ftp.request.command' in df.columns:
-        ftp_close_events = df[df['ftp.request.command'].str.upper().str.contains('QUIT') | df.get('ftp.response.code', pd.Series(dtype=str)).str.startswith('221')]
+    if pd.isna(closed_ts) and has_ftp_command:
+        ftp_close_mask = df['ftp.request.command'].str.contains(FTP_CLOSE_COMMAND_RE, na=False)
+        if has_ftp_response:
+            ftp_close_mask |= df['ftp.response.code'].isin([221])
+        ftp_close_events = df[ftp_close_mask]
         if not ftp_close_events.empty:
             closed_ts = ftp_close_events['frame.time'].max()
 
-    metrics["ftp_conn_opened_timestamp"] = opened_ts.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] if pd.notna(opened_ts) else ""
-    metrics["ftp_conn_closed_timestamp"] = closed_ts.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] if pd.notna(closed_ts) else ""
+    return {
+        "ftp_conn_opened_timestamp": format_epoch_timestamp(opened_ts),
+        "ftp_conn_closed_timestamp": format_epoch_timestamp(closed_ts)
+    }
 
+def calculate_metrics(df, duration_s, rtt_field, camera_ips):
+    """Calculates network metrics from a pandas DataFrame."""
+    # Missing counter columns are reindexed in as all-NaN, so they count as 0
+    counts = df.reindex(columns=list(TSHARK_COUNTER_METRICS)).notna().sum()
+    total_bytes = df['frame.len'].sum() if 'frame.len' in df.columns else 0
+    rtt_mean_s = df[rtt_field].mean() if rtt_field in df.columns else float('nan')
+
+    metrics = summarize_traffic_metrics(counts, total_bytes, rtt_mean_s, duration_s)
+    metrics.update(find_connection_timestamps(df, camera_ips))
     return metrics
 
+def split_by_camera(df, camera_ips):
+    """Returns the rows sent from or to each camera, tagged with a 'camera_ip' column."""
+    # A packet belongs to every camera it was sent from or to, as with a src/dst filter per camera
+    from_camera = df[df['ip.src'].isin(camera_ips)].assign(camera_ip=lambda d: d['ip.src'])
+    to_camera = df[df['ip.dst'].isin(camera_ips) & (df['ip.dst'] != df['ip.src'])].assign(camera_ip=lambda d: d['ip.dst'])
+    return pd.concat([from_camera, to_camera], ignore_index=True)
+
+def calculate_per_camera_metrics(df, camera_ips, duration_s, rtt_field):
+    """Calculates network metrics for each camera IP in one grouped pass over the DataFrame."""
+    # Aggregate on a narrow projection so the per-camera copies only carry the numeric columns
+    traffic_cols = [col for col in [*TSHARK_COUNTER_METRICS, 'frame.len', rtt_field] if col in df.columns]
+    df_traffic = split_by_camera(df[['ip.src', 'ip.dst'] + traffic_cols], camera_ips)
+
+    grouped = df_traffic.groupby('camera_ip', sort=False, observed=True)
+    counts = df_traffic.reindex(columns=list(TSHARK_COUNTER_METRICS)).notna().groupby(df_traffic['camera_ip'], sort=False, observed=True).sum()
+    total_bytes = grouped['frame.len'].sum()
+    rtt_means_s = grouped[rtt_field].mean() if rtt_field in df_traffic.columns else pd.Series(dtype='float64')
+
+    # Connection open/close detection only needs the handshake, teardown and FTP control packets
+    event_mask = pd.Series(False, index=df.index)
+    for col in ('tcp.flags.syn', 'tcp.flags.fin', 'tcp.flags.reset'):
+        event_mask |= df[col] == 'True'
+    if 'ftp.request.command' in df.columns:
+        event_mask |= df['ftp.request.command'] != ''
+    if 'ftp.response.code' in df.columns:
+        event_mask |= df['ftp.response.code'].notna()
+    df_events = split_by_camera(df[event_mask], camera_ips)
+    events_by_camera = dict(iter(df_events.groupby('camera_ip', sort=False, observed=True)))
+
+    per_camera = {}
+    for ip in counts.index:
+        metrics = summarize_traffic_metrics(counts.loc[ip], total_bytes[ip], rtt_means_s.get(ip, float('nan')), duration_s)
+        metrics.update(find_connection_timestamps(events_by_camera.get(ip, df_events.iloc[0:0]), [ip]))
+        per_camera[ip] = metrics
+    return per_camera
+
+def get_capture_packet_count(capture_file_path):
+    """Returns the packet count of a capture file using capinfos, or None if it cannot be determined."""
+    try:
+        result = subprocess.run(["capinfos", "-M", "-c", capture_file_path], capture_output=True, text=True, check=True, timeout=30)
+    except Exception as e:
+        logging.warning(f"Could not summarize capture with capinfos: {e}. Continuing with full analysis.")
+        return None
+    count_match = re.search(r"Number of packets:\s*(\d+)", result.stdout)
+    if not count_match:
+        logging.warning("Could not parse the packet count from capinfos output. Continuing with full analysis.")
+        return None
+    return int(count_match.group(1))
+
+def parse_tshark_export_with_arrow(stream):
+    """Parses the tab-separated tshark export with pyarrow's multithreaded CSV reader, matching pandas' dtypes."""
+    arrow_types = {
+        "float64": pa.float64(), "float32": pa.float32(), "Int16": pa.int16(), "string": pa.string(),
+        "category": pa.dictionary(pa.int32(), pa.string())
+    }
+    column_types = {col: arrow_types[dtype] for col, dtype in {**TSHARK_NUMERIC_DTYPES, **TSHARK_TEXT_DTYPES}.items()}
+    table = pa_csv.read_csv(
+        stream,
+        parse_options=pa_csv.ParseOptions(delimiter='\t', quote_char=False),
+        # '' is null in numeric columns only; text columns keep '' as with the pandas reader
+        convert_options=pa_csv.ConvertOptions(column_types=column_types, null_values=[''], strings_can_be_null=False)
+    )
+    return table.to_pandas(types_mapper={pa.int16(): pd.Int16Dtype(), pa.string(): pd.StringDtype()}.get)
+
+def read_tshark_export(capture_file_path):
+    """Streams the tshark field export of a capture into a DataFrame. Returns (df, rtt_field)."""
+    tshark_fields = get_tshark_export_fields()
+    # Tab-separated and unquoted, so pandas does not need to handle quoting. Only the first occurrence of
+    # each field is kept so numeric columns (e.g. several FTP replies in one segment) parse as single values.
+    tshark_command = ["tshark", "-r", capture_file_path, "-T", "fields"] + tshark_fields + ["-E", "header=y", "-E", "separator=/t", "-E", "quote=n", "-E", "occurrence=f"]
+
+    logging.info("Streaming tshark export into pandas for analysis...")
+    # Parse tshark's stdout directly instead of round-tripping it through a temporary CSV file
+    with subprocess.Popen(tshark_command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=1 << 20) as proc:
+        if pa_csv is not None:
+            df = parse_tshark_export_with_arrow(proc.stdout)
+        else:
+            df = pd.read_csv(
+                proc.stdout, sep='\t',
+                dtype={**TSHARK_NUMERIC_DTYPES, **TSHARK_TEXT_DTYPES},
+                na_values={col: [''] for col in TSHARK_NUMERIC_DTYPES}, keep_default_na=False
+            )
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, tshark_command)
+    return df, get_rtt_field_name()
+
+# --- Fast Pcap Reader (optional dpkt backend) ---
+DPKT_RTT_FIELD = "tcp.analysis.ack_rtt"
+DPKT_COLUMNS = [
+    "frame.time_epoch", "frame.len", "ip.src", "ip.dst",
+    "tcp.analysis.retransmission", "tcp.analysis.zero_window", "tcp.analysis.window_full",
+    "tcp.analysis.lost_segment", "tcp.analysis.duplicate_ack",
+    "ftp.request.command", "ftp.response.code",
+    "tcp.flags.syn", "tcp.flags.fin", "tcp.flags.reset", DPKT_RTT_FIELD
+]
+# Link-layer header size per pcap link type, used to rebuild frame.len for snaplen-truncated packets
+DPKT_LINK_HEADER_LEN = {1: 14, 113: 16}  # DLT_EN10MB, DLT_LINUX_SLL
+
+TCP_SEQ_MASK = 0xFFFFFFFF
+
+def seq_before(a, b):
+    """True if sequence number a comes before b, modulo 2**32 (RFC 1982 serial arithmetic)."""
+    return 0 < (b - a) & TCP_SEQ_MASK < 2**31
+
+def seq_not_after(a, b):
+    """True if sequence number a equals or comes before b, modulo 2**32."""
+    return (b - a) & TCP_SEQ_MASK < 2**31
+
+def analyze_tcp_segment(flows, tcp, src, dst, payload_len, ts):
+    """
+    Tracks per-direction TCP state and returns the analysis flags and ACK RTT for one segment.
+
+    This approximates Wireshark's sequence analysis (no SACK handling), which is enough
+    for the summary counters. Sequence numbers are compared modulo 2**32 so flows that
+    wrap around keep their state, and keep-alives are not counted as retransmissions.
+    """
+    syn, fin, rst, ack = (bool(tcp.flags & f) for f in (dpkt.tcp.TH_SYN, dpkt.tcp.TH_FIN, dpkt.tcp.TH_RST, dpkt.tcp.TH_ACK))
+    key = (src, tcp.sport, dst, tcp.dport)
+    fwd = flows.setdefault(key, {"next_seq": None, "last_ack": None, "last_win": None, "win_scale": 1, "unacked": {}})
+    rev = flows.get((dst, tcp.dport, src, tcp.sport))
+
+    seg_len = payload_len + syn + fin
+    seq_end = (tcp.seq + seg_len) & TCP_SEQ_MASK
+    window = tcp.win if syn else tcp.win * fwd["win_scale"]
+    retransmission = lost_segment = window_full = duplicate_ack = keep_alive = False
+    zero_window = tcp.win == 0 and not (syn or fin or rst)
+    rtt = None
+
+    if syn:
+        for opt, data in dpkt.tcp.parse_opts(tcp.opts):
+            if opt == dpkt.tcp.TCP_OPT_WSCALE and data:
+                fwd["win_scale"] = 1 << data[0]
+
+    if fwd["next_seq"] is not None and not rst:
+        # Keep-alives resend the byte just before next_seq; Wireshark reports them separately
+        keep_alive = seg_len <= 1 and not (syn or fin) and tcp.seq == (fwd["next_seq"] - 1) & TCP_SEQ_MASK
+        if seg_len > 0 and not keep_alive and seq_not_after(seq_end, fwd["next_seq"]):
+            retransmission = True
+        elif seq_before(fwd["next_seq"], tcp.seq):
+            lost_segment = True
+
+    if rev is not None and seg_len > 0 and rev["last_ack"] is not None and rev["last_win"] is not None:
+        window_full = seq_end == (rev["last_ack"] + rev["last_win"]) & TCP_SEQ_MASK
+
+    if (ack and seg_len == 0 and not (syn or fin or rst) and tcp.ack == fwd["last_ack"] and window == fwd["last_win"]
+            and rev is not None and rev["next_seq"] is not None and rev["next_seq"] != tcp.ack):
+        duplicate_ack = True
+
+    if ack and rev is not None and rev["unacked"]:
+        acked = [end for end in rev["unacked"] if seq_not_after(end, tcp.ack)]
+        if acked:
+            # The most recently sent acked segment is the one closest below the ACK
+            latest = min(acked, key=lambda end: (tcp.ack - end) & TCP_SEQ_MASK)
+            rtt = ts - rev["unacked"][latest]
+            for end in acked:
+                del rev["unacked"][end]
+
+    if seg_len > 0 and not (retransmission or keep_alive):
+        fwd["unacked"][seq_end] = ts
+    if fwd["next_seq"] is None or seq_before(fwd["next_seq"], seq_end):
+        fwd["next_seq"] = seq_end
+    if ack:
+        fwd["last_ack"], fwd["last_win"] = tcp.ack, window
+
+    return retransmission, zero_window, window_full, lost_segment, duplicate_ack, rtt
+
+def read_pcap_with_dpkt(capture_file_path):
+    """
+    Reads a pcap/pcapng capture in-process with dpkt, in a single pass and without tshark.
+    Returns (df, rtt_field) with the same columns and dtypes as read_tshark_export,
+    or None if the capture's link type is not supported.
+    """
+    rows = []
+    flows = {}
+    with open(capture_file_path, 'rb') as f:
+        reader = dpkt.pcap.UniversalReader(f)
+        datalink = reader.datalink()
+        link_header_len = DPKT_LINK_HEADER_LEN.get(datalink)
+        if link_header_len is None:
+            logging.warning(f"Link type {datalink} is not supported by the dpkt reader.")
+            return None
+        for ts, buf in reader:
+            ts = float(ts)
+            row = [ts, float(len(buf)), "", "", None, None, None, None, None, "", None, "", "", "", None]
+            rows.append(row)
+            try:
+                frame = dpkt.ethernet.Ethernet(buf) if datalink == 1 else dpkt.sll.SLL(buf)
+            except dpkt.dpkt.Error:
+                continue
+            ip = frame.data
+            if not isinstance(ip, dpkt.ip.IP):
+                continue
+
+            # With a snaplen the buffer is truncated, so take the original size from the IP header
+            row[1] = float(max(len(buf), link_header_len + ip.len))
+            row[2], row[3] = socket.inet_ntoa(ip.src), socket.inet_ntoa(ip.dst)
+            tcp = ip.data
+            if not isinstance(tcp, dpkt.tcp.TCP):
+                continue
+
+            payload_len = max(ip.len - ip.hl * 4 - tcp.off * 4, 0)
+            retransmission, zero_window, window_full, lost_segment, duplicate_ack, rtt = analyze_tcp_segment(
+                flows, tcp, row[2], row[3], payload_len, ts)
+            row[4:9] = [1.0 if flag else None for flag in (retransmission, zero_window, window_full, lost_segment, duplicate_ack)]
+            row[11:14] = [str(bool(tcp.flags & f)) for f in (dpkt.tcp.TH_SYN, dpkt.tcp.TH_FIN, dpkt.tcp.TH_RST)]
+            row[14] = rtt
+
+            if tcp.data and 21 in (tcp.sport, tcp.dport):
+                line = bytes(tcp.data).split(b'\r\n', 1)[0].decode('ascii', 'replace')
+                if tcp.dport == 21:
+                    row[9] = line.split(' ', 1)[0]
+                elif line[:3].isdigit():
+                    row[10] = int(line[:3])
+
+    df = pd.DataFrame.from_records(rows, columns=DPKT_COLUMNS)
+    dtypes = {col: dtype for col, dtype in {**TSHARK_NUMERIC_DTYPES, **TSHARK_TEXT_DTYPES}.items() if col in df.columns}
+    return df.astype(dtypes), DPKT_RTT_FIELD
+
 # --- Tshark Analysis Function ---
-def analyze_tshark_capture(capture_file_path, capture_duration_s, configured_camera_ips, true_timestamps, false_timestamps):
-    """Exports and analyzes tshark capture data for network metrics."""
+def analyze_tshark_capture(capture_file_path, capture_duration_s, configured_camera_ips, true_timestamps, false_timestamps, fast_pcap=False):
+    """Reads a capture file (via tshark, or dpkt when fast_pcap is set) and analyzes it for network metrics."""
     default_metrics = {
         "total_retransmissions": 0, "zero_window_count": 0, "window_full_count": 0,
         "avg_rtt_ms": 0.0, "lost_segments_count": 0, "duplicate_ack_count": 0,
@@ -229,37 +571,47 @@ def analyze_tshark_capture(capture_file_path, capture_duration_s, configured_cam
     max_bleed_times = {ip: 0 for ip in configured_camera_ips}
     default_return = ({"overall": default_metrics, "per_camera": []}, max_bleed_times)
 
-    tshark_fields = get_tshark_export_fields()
-    temp_csv_file = "temp_tshark_analysis.csv"
-    tshark_command = ["tshark", "-r", capture_file_path, "-T", "fields"] + tshark_fields + ["-E", "header=y", "-E", "separator=,", "-E", "quote=d"]
-    
+    # A quick capinfos packet count avoids exporting and parsing a capture that has nothing to analyze
+    # Only an empty capture is skipped; short captures are still analyzable because
+    # throughput is computed over capture_duration_s, not the packet span
+    if get_capture_packet_count(capture_file_path) == 0:
+        logging.warning("Capture holds no packets. Skipping analysis.")
+        return default_return
+
     try:
-        logging.info("Exporting tshark data to temporary CSV for analysis...")
-        result = subprocess.run(tshark_command, check=True, capture_output=True, text=True)
-        with open(temp_csv_file, 'w', newline='', encoding='utf-8') as f:
-            f.write(result.stdout)
+        export = None
+        if fast_pcap and dpkt is None:
+            logging.warning("'fast_pcap' is enabled but dpkt is not installed. Falling back to tshark.")
+        elif fast_pcap:
+            logging.info("Reading capture in-process with dpkt for analysis...")
+            export = read_pcap_with_dpkt(capture_file_path)
+            if export is None:
+                logging.warning("Falling back to tshark for this capture.")
+        if export is None:
+            export = read_tshark_export(capture_file_path)
+        df, rtt_field = export
     except Exception as e:
-        logging.error(f"Tshark export failed: {e}", exc_info=True)
+        logging.error(f"Capture export failed: {e}", exc_info=True)
         return default_return
 
     try:
-        df = pd.read_csv(temp_csv_file, dtype=str).fillna('')
-        # CORRECTED: Ensure the datetime objects are timezone-aware (UTC)
-        df['frame.time'] = pd.to_datetime(df['frame.time_epoch'], unit='s', errors='coerce').dt.tz_localize('UTC')
-        df['frame.len'] = pd.to_numeric(df['frame.len'], errors='coerce').fillna(0)
-
-        detected_ips = {ip for ip in configured_camera_ips if (df['ip.src'] == ip).any() or (df['ip.dst'] == ip).any()}
+        # Share one category set between the address columns so they can be compared with each other
+        ip_categories = df['ip.src'].cat.categories.union(df['ip.dst'].cat.categories)
+        df[['ip.src', 'ip.dst']] = df[['ip.src', 'ip.dst']].astype(pd.CategoricalDtype(ip_categories))
+        # Packet times stay float epoch seconds; only the reported open/close times become datetimes
+        df = df.rename(columns={'frame.time_epoch': 'frame.time'})
+
+        seen_ips = set(df['ip.src'].unique()) | set(df['ip.dst'].unique())
+        detected_ips = {ip for ip in configured_camera_ips if ip in seen_ips}
         ftp_server_ip = next((ip for ip in pd.concat([df['ip.src'], df['ip.dst']]).unique() if ip not in configured_camera_ips and not (ip.startswith('192.168.') and ip.endswith('.255'))), None)
-        rtt_field = get_rtt_field_name()
         
         overall_metrics = calculate_metrics(df, capture_duration_s, rtt_field, configured_camera_ips)
         overall_metrics["num_cameras_detected"] = len(detected_ips)
         logging.info(f"Overall analysis results: {overall_metrics}")
 
+        per_camera_metrics = calculate_per_camera_metrics(df, detected_ips, capture_duration_s, rtt_field)
         per_camera_metrics_list = []
-        for ip in detected_ips:
-            df_cam = df[(df['ip.src'] == ip) | (df['ip.dst'] == ip)].copy()
-            cam_metrics = calculate_metrics(df_cam, capture_duration_s, rtt_field, [ip])
+        for ip, cam_metrics in per_camera_metrics.items():
             cam_metrics["num_cameras_detected"] = 1
             per_camera_metrics_list.append({"ip": ip, "metrics": cam_metrics})
             logging.info(f"Analysis for {ip}: {cam_metrics}")
@@ -268,8 +620,8 @@ def analyze_tshark_capture(capture_file_path, capture_duration_s, configured_cam
         if len(true_timestamps) > 1 and ftp_server_ip:
             logging.info(f"Analyzing data bleed during 'off' intervals. FTP Server detected: {ftp_server_ip}")
             for i in range(len(true_timestamps) - 1):
-                start_off_period = false_timestamps[i]
-                end_off_period = true_timestamps[i+1]
+                start_off_period = false_timestamps[i].timestamp()
+                end_off_period = true_timestamps[i+1].timestamp()
                 
                 for ip in configured_camera_ips:
                     off_period_df = df[
@@ -282,7 +634,7 @@ def analyze_tshark_capture(capture_file_path, capture_duration_s, configured_cam
                     
                     if not data_packets.empty:
                         last_packet_time = data_packets['frame.time'].max()
-                        bleed_time = (last_packet_time - start_off_period).total_seconds() * 1000
+                        bleed_time = (last_packet_time - start_off_period) * 1000
                         
                         if bleed_time > max_bleed_times[ip]:
                             max_bleed_times[ip] = bleed_time
@@ -293,11 +645,8 @@ def analyze_tshark_capture(capture_file_path, capture_duration_s, configured_cam
         return analysis_result, max_bleed_times
 
     except Exception as e:
-        logging.error(f"Error analyzing tshark CSV: {e}", exc_info=True)
+        logging.error(f"Error analyzing capture data: {e}", exc_info=True)
         return default_return
-    finally:
-        if os.path.exists(temp_csv_file):
-            os.remove(temp_csv_file)
 
 # --- Main Application Logic ---
 def run_analyzer():
@@ -327,11 +676,16 @@ def run_analyzer():
             duration = (repeats * (config["interval_true_false"] + config["interval_false_true"])) / 1000 if repeats != -1 else 600
             capture_duration_s = max(duration, 5)
 
-            capture_filter = " or ".join([f"host {ip}" for ip in config["camera_ips"]])
+            host_filter = " or ".join([f"host {ip}" for ip in config["camera_ips"]])
+            # Only TCP (FTP control + data) traffic feeds the metrics, so let BPF drop the rest in the kernel
+            capture_filter = f"tcp and ({host_filter})" if host_filter else ""
             tshark_cmd = [
                 "tshark", "-i", config["tshark_interface"], "-w", config["tshark_temp_capture_file"],
                 "-a", f"duration:{capture_duration_s}"
             ]
+            if config["tshark_snaplen"] > 0:
+                # Headers are enough for TCP analysis and FTP commands; frame.len still reports the full size
+                tshark_cmd.extend(["-s", str(config["tshark_snaplen"])])
             if capture_filter:
                 tshark_cmd.extend(["-f", capture_filter])
                 logging.info(f"Starting tshark on '{config['tshark_interface']}' for {capture_duration_s:.2f}s with filter: '{capture_filter}'")
@@ -349,21 +703,35 @@ def run_analyzer():
     
     true_message_timestamps = []
     false_message_timestamps = []
+    # Encode payloads and resolve settings once so the publish loop does no per-cycle conversions
+    topic = config["mqtt_topic"]
+    true_message, false_message = config["true_message"], config["false_message"]
+    true_payload = true_message.encode('utf-8')
+    false_payload = false_message.encode('utf-8')
+    true_false_s = config["interval_true_false"] / 1000.0
+    false_true_s = config["interval_false_true"] / 1000.0
+    publish = client.publish
     try:
-        logging.info(f"Starting MQTT publication to topic '{config['mqtt_topic']}' for {config['repeats']} cycles.")
+        repeats_label = "Infinite" if config['repeats'] == -1 else str(config['repeats'])
+        logging.info(f"Starting MQTT publication to topic '{topic}' for {repeats_label} cycles.")
         loop_iterator = range(config['repeats']) if config['repeats'] != -1 else iter(int, 1)
+        # Sleep towards absolute deadlines so publish/logging time does not accumulate as drift
+        next_tick = time.monotonic()
         for i in loop_iterator:
-            client.publish(config["mqtt_topic"], config["true_message"])
+            publish(topic, true_payload)
             # CORRECTED: Use timezone-aware UTC timestamps
             true_message_timestamps.append(datetime.now(timezone.utc))
-            logging.info(f"Published '{config['true_message']}' (Cycle {i+1})")
-            time.sleep(config["interval_true_false"] / 1000.0)
+            # Lazy %-formatting: the message is only built if a handler actually emits it
+            logging.info("Published '%s' (Cycle %d)", true_message, i + 1)
+            next_tick += true_false_s
+            time.sleep(max(0.0, next_tick - time.monotonic()))
 
-            client.publish(config["mqtt_topic"], config["false_message"])
+            publish(topic, false_payload)
             # CORRECTED: Use timezone-aware UTC timestamps
             false_message_timestamps.append(datetime.now(timezone.utc))
-            logging.info(f"Published '{config['false_message']}' (Cycle {i+1})")
-            time.sleep(config["interval_false_true"] / 1000.0)
+            logging.info("Published '%s' (Cycle %d)", false_message, i + 1)
+            next_tick += false_true_s
+            time.sleep(max(0.0, next_tick - time.monotonic()))
         logging.info("Finished all test cycles.")
     except KeyboardInterrupt:
         logging.info("Test interrupted by user.")
@@ -386,10 +754,13 @@ def run_analyzer():
         time.sleep(config['ftp_management_delay_seconds'])
 
         per_camera_ftp_data = {}
-        for ip in config["camera_ips"]:
-            sub_folder = os.path.join(config["ftp_folder_to_manage"], ip.split('.')[-1])
-            num_before, avg_bytes, num_after = manage_specific_ftp_folder(sub_folder)
-            per_camera_ftp_data[ip] = {"files_before": num_before, "avg_bytes_per_file": avg_bytes, "files_after": num_after}
+        camera_ips = config["camera_ips"]
+        if camera_ips:
+            sub_folders = [os.path.join(config["ftp_folder_to_manage"], ip.split('.')[-1]) for ip in camera_ips]
+            # Folder cleanup is I/O bound, so the cameras' folders are processed concurrently
+            with ThreadPoolExecutor(max_workers=min(8, len(camera_ips))) as executor:
+                for ip, (num_before, avg_bytes, num_after) in zip(camera_ips, executor.map(manage_specific_ftp_folder, sub_folders)):
+                    per_camera_ftp_data[ip] = {"files_before": num_before, "avg_bytes_per_file": avg_bytes, "files_after": num_after}
 
         analysis_results = None
         max_bleed_times = {ip: 0 for ip in config["camera_ips"]}
@@ -399,7 +770,8 @@ def run_analyzer():
                 capture_duration_s, 
                 config["camera_ips"],
                 true_message_timestamps,
-                false_message_timestamps
+                false_message_timestamps,
+                fast_pcap=config["fast_pcap"]
             )
         
         current_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
@@ -441,7 +813,7 @@ def run_analyzer():
                 rows_to_append.append(cam_row)
         try:
             if rows_to_append:
-                worksheet.append_rows(rows_to_append)
+                worksheet.append_rows(rows_to_append, value_input_option="RAW")
                 logging.info(f"Successfully appended {len(rows_to_append)} rows to Google Sheet.")
         except Exception as e:
             logging.error(f"Failed to append data to Google Sheet: {e}", exc_info=True)